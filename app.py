@@ -4,15 +4,21 @@
 # We then use GPT to compare and contrast to finally come up with a final answer
 # We're using streamlit to make it a web app
 import os
+import json
+import time
+import hashlib
+import itertools
+import difflib
+import threading
 from apikey import apikey
 
 import streamlit as st
 import openai
-from langchain.llms import OpenAI
-from langchain.chat_models import ChatOpenAI
-from langchain.prompts import PromptTemplate
-from langchain.chains import LLMChain, SequentialChain
+import requests
+import tenacity
 os.environ['OPENAI_API_KEY'] = apikey
+# api key retrieval
+openai.api_key = apikey
 
 # Turn on this flag to see the debug output
 _DEBUG_MODE = False
@@ -24,12 +30,312 @@ _WELCOME_MSG = "What's on your mind today?"
 _INITIAL_Q_PROMPT = "Answer the following carefully. Reflect on your answer \n"
 _DOUBLE_CHECKER_PROMPT = "You are given a question and an answer below. The answer may be wrong so double check the following question and answer:"
 _REPETITIONS = 2
-_COMPARISON_PROMPT = "You are a researcher investigating the {repetition} answers to the question [[{question}]], each answer delimited by '''. \
-    Compare and contrast these answers. Let's think about this step by step to make sure we find all inconsistencies."
-_FINAL_ANSWER_PROMPT = "You are a resolver tasked to 1) find the best answer based on a compare-contrast opinion below, delimited by <<< and >>> \
-    2) Improve on the answer. Let's think about this step by step to make sure we have the correct answer."
+# each sampled reply holds both the answer and its self-check, so it gets room for two answers
+_ANSWER_MAX_TOKENS = 1000
+# Model routing: answering and resolving need the selected model's reasoning, so they run on it;
+# summarizing an answer that is already settled is a mechanical rewrite, so it always runs on this cheaper model
+_CHEAP_MODEL = 'gpt-3.5-turbo'
+# checked answers this similar to each other (token-set Jaccard) skip the resolution stage
+_AGREEMENT_THRESHOLD = 0.9
+# candidate answers at least this similar (difflib ratio) to one already kept are dropped before resolution
+_DUPLICATE_THRESHOLD = 0.85
+# total tokens of candidate answers sent for resolution, split evenly between the candidates
+_ANSWER_TOKEN_BUDGET = 1500
+# separator between answers, each of which is enclosed in '''
+_ANSWER_DELIMITER = "'''\n'''"
+_RESOLVE_PROMPT = "Below are the {repetition} candidate answers to the question [[{question}]], each answer delimited by '''. \
+    Internally compare and contrast these answers, pick or improve on the best one, and return ONLY a concise final answer, with no explanation."
 _SUMMARY_PROMPT = "Summarize the following answer to be more concise and straight to the point. Remove any unnecessary explanation: "
 
+# Size of the keep-alive connection pool shared by all OpenAI calls
+_HTTP_POOL_SIZE = 16
+
+# Transient OpenAI failures are retried with exponential backoff, and at most
+# _MAX_IN_FLIGHT OpenAI requests run at once across all browser sessions
+_RETRY_ATTEMPTS = 5
+_MAX_IN_FLIGHT = 8
+_TRANSIENT_ERRORS = (openai.error.RateLimitError, openai.error.ServiceUnavailableError, openai.error.APIError,
+                     openai.error.APIConnectionError, openai.error.Timeout)
+
+# Exact-match cache: answers and question embeddings are kept on disk, shared by all workers, for _CACHE_TTL seconds;
+# semantic cache entries expire after the same _CACHE_TTL
+_CACHE_PATH = ".cache"
+_CACHE_SIZE_LIMIT = int(1e9)
+_CACHE_TTL = 604800
+
+# Semantic cache: a previous answer is reused when its question embeds within this cosine similarity
+_EMBEDDING_MODEL = "text-embedding-3-small"
+# LangChain sends longer questions through tiktoken, which does not know _EMBEDDING_MODEL;
+# questions this long skip the semantic cache
+_EMBEDDING_MAX_CHARS = 8191
+_SEMANTIC_CACHE_PATH = ".semcache"
+_SEMANTIC_CACHE_THRESHOLD = 0.92
+
+# Prompt Templates
+# initial question and double-checking of the answer, in one call
+_QUESTION_TEMPLATE = "{initial_q_prompt} Question: {question}\n\n" \
+                     "Now, critically double-check your own answer per: {double_checker_prompt}\n" \
+                     "Return JSON: {{\"answer\": ..., \"checked_answer\": ...}}"
+# comparison, synthesis and summary of collected answers, in one call
+_RESOLVE_TEMPLATE = "{resolve_prompt} {answers}"
+# summary of final answer to be more concise
+_SUMMARY_TEMPLATE = "{summary_prompt} {final_answer}"
+
+
+# sample _REPETITIONS independent completions from a single request (n=),
+# so the prompt is sent and prefilled once for all of them;
+# replies cut off at _ANSWER_MAX_TOKENS hold incomplete JSON and are dropped
+def _sample_answers(model, prompt):
+    response = openai.ChatCompletion.create(model=model, messages=[{'role': 'user', 'content': prompt}],
+                                            n=_REPETITIONS, temperature=0.9, max_tokens=_ANSWER_MAX_TOKENS)
+    return [choice['message']['content'] for choice in response['choices'] if choice['finish_reason'] != 'length']
+
+
+# split the JSON reply to the question prompt into (answer, checked_answer);
+# the object is cut out of any ```json fence or surrounding prose first,
+# and if there is still no usable object, the whole reply is treated as both
+def _parse_answer(text):
+    start, end = text.find('{'), text.rfind('}')
+    try:
+        if start == -1 or end < start:
+            raise ValueError("no JSON object in reply")
+        output = json.loads(text[start:end + 1])
+        return str(output['answer']), str(output['checked_answer'])
+    except (ValueError, TypeError, KeyError):
+        return text, text
+
+
+# token-set Jaccard similarity of two answers
+def _jaccard(a, b):
+    a, b = set(a.split()), set(b.split())
+    return len(a & b) / len(a | b) if a | b else 1.0
+
+
+# true when every pair of answers is near-identical, i.e. GPT was self-consistent
+def _answers_agree(answers):
+    return all(_jaccard(a, b) > _AGREEMENT_THRESHOLD for a, b in itertools.combinations(answers, 2))
+
+
+# drop answers that are near-duplicates of an earlier one, keeping the original order
+def _dedupe(answers):
+    uniq = []
+    for a in answers:
+        if all(difflib.SequenceMatcher(None, a, existing).ratio() < _DUPLICATE_THRESHOLD for existing in uniq):
+            uniq.append(a)
+    return uniq
+
+
+@st.cache_resource
+def _encoder(model):
+    import tiktoken
+    return tiktoken.encoding_for_model(model)
+
+
+# cut every answer down to its share of _ANSWER_TOKEN_BUDGET so the resolution prompt stays bounded
+def _truncate(answers, model):
+    encoder = _encoder(model)
+    budget = _ANSWER_TOKEN_BUDGET // len(answers)
+    return [encoder.decode(encoder.encode(a)[:budget]) for a in answers]
+
+
+# one pooled keep-alive HTTP session for the whole process; openai otherwise opens a new one
+# per thread, and streamlit runs every rerun on a fresh thread, paying TCP + TLS setup each time
+@st.cache_resource
+def _http_session():
+    session = requests.Session()
+    session.mount('https://', requests.adapters.HTTPAdapter(pool_connections=_HTTP_POOL_SIZE,
+                                                            pool_maxsize=_HTTP_POOL_SIZE, max_retries=2))
+    return session
+
+
+# shared by every script run in the process, so it caps requests across sessions
+@st.cache_resource
+def _request_slots():
+    return threading.Semaphore(_MAX_IN_FLIGHT)
+
+
+# call fn, which sends an OpenAI request, once a request slot is free;
+# transient failures release the slot, back off and try again
+@tenacity.retry(stop=tenacity.stop_after_attempt(_RETRY_ATTEMPTS),
+                wait=tenacity.wait_random_exponential(multiplier=1, max=30),
+                retry=tenacity.retry_if_exception_type(_TRANSIENT_ERRORS), reraise=True)
+def _call_openai(fn, *args, **kwargs):
+    with _request_slots():
+        return fn(*args, **kwargs)
+
+
+# key identifying a question asked of a given model
+def _cache_key(model, question):
+    return hashlib.sha256(f"{model}|{question}".encode()).hexdigest()
+
+
+# sqlite-backed store that survives restarts and redeploys
+@st.cache_resource
+def _cache():
+    import diskcache
+    return diskcache.Cache(_CACHE_PATH, size_limit=_CACHE_SIZE_LIMIT)
+
+
+def _cached_answer(model, question):
+    return _cache().get(f"answer|{_cache_key(model, question)}")
+
+
+def _cache_answer(model, question, summary):
+    _cache().set(f"answer|{_cache_key(model, question)}", summary, expire=_CACHE_TTL)
+
+
+@st.cache_resource
+def _embeddings():
+    from langchain.embeddings import OpenAIEmbeddings
+    # a single attempt; _call_openai does the retrying, outside the request slot
+    return OpenAIEmbeddings(model=_EMBEDDING_MODEL, deployment=_EMBEDDING_MODEL, max_retries=1)
+
+
+# embedding of a question; it does not depend on the chat model, so a question asked again of another model reuses it
+# returns None when the question cannot be embedded, since the semantic cache is only a shortcut
+def _embed(question):
+    if len(question) > _EMBEDDING_MAX_CHARS:
+        return None
+    key = f"embedding|{_EMBEDDING_MODEL}|{hashlib.sha256(question.encode()).hexdigest()}"
+    embedding = _cache().get(key)
+    if embedding is None:
+        try:
+            embedding = _call_openai(_embeddings().embed_query, question)
+        except openai.error.OpenAIError:
+            return None
+        _cache().set(key, embedding, expire=_CACHE_TTL)
+    return embedding
+
+
+# local vector store of previously answered questions, compared by cosine distance
+@st.cache_resource
+def _semantic_cache():
+    import chromadb
+    client = chromadb.PersistentClient(path=_SEMANTIC_CACHE_PATH)
+    return client.get_or_create_collection('answers', metadata={'hnsw:space': 'cosine'})
+
+
+# return the summary of the closest previously answered question, if it is similar enough
+def _semantic_lookup(model, embedding):
+    collection = _semantic_cache()
+    if collection.count() == 0:
+        return None
+    # entries older than _CACHE_TTL are treated as missing
+    fresh = {'$and': [{'model': model}, {'created': {'$gt': time.time() - _CACHE_TTL}}]}
+    results = collection.query(query_embeddings=[embedding], n_results=1, where=fresh)
+    if results['ids'][0] and 1 - results['distances'][0][0] > _SEMANTIC_CACHE_THRESHOLD:
+        return results['metadatas'][0][0]['summary']
+    return None
+
+
+# store a new answer and drop the expired ones, so .semcache/ only holds the last _CACHE_TTL of answers
+def _semantic_store(model, question, embedding, summary):
+    collection = _semantic_cache()
+    collection.delete(where={'created': {'$lte': time.time() - _CACHE_TTL}})
+    collection.upsert(ids=[_cache_key(model, question)], embeddings=[embedding], documents=[question],
+                      metadatas=[{'model': model, 'summary': summary, 'created': time.time()}])
+
+
+# callback handler rendering the tokens of a streaming LLM into a streamlit placeholder as they arrive
+def _stream_handler(placeholder):
+    from langchain.callbacks.base import BaseCallbackHandler
+
+    class StreamHandler(BaseCallbackHandler):
+        text = ''
+
+        # a retried call streams again from the start
+        def on_llm_start(self, serialized, prompts, **kwargs):
+            self.text = ''
+
+        def on_llm_new_token(self, token, **kwargs):
+            self.text += token
+            placeholder.markdown(self.text)
+
+    return StreamHandler()
+
+
+# llms and chains for a model, built once per process instead of on every streamlit rerun
+@st.cache_resource
+def _build_chains(model):
+    # langchain is slow to import, so it is only loaded once a question is submitted
+    from langchain.chat_models import ChatOpenAI
+    from langchain.prompts import PromptTemplate
+    from langchain.chains import LLMChain
+    import langchain
+
+    # chain tracing prints every prompt and response, so it is only on in debug mode
+    langchain.verbose = _DEBUG_MODE
+
+    # llms initialization; both chains stream their output to the page
+    # max_retries=1 is a single attempt: _call_openai does the retrying, outside the request slot
+    llm_primary = ChatOpenAI(temperature=0.9, client=None, model=model, max_tokens= 500, streaming=True, max_retries=1)
+    llm_cheap = ChatOpenAI(temperature=0.9, client=None, model=_CHEAP_MODEL, max_tokens= 500, streaming=True, max_retries=1)
+
+    # chain initialization
+    # resolve_chain compares the answers, synthesizes the final answer and summarizes it in a single call
+    # summary_chain only summarizes, for when the answers already agree
+    resolve_chain = LLMChain(llm=llm_primary, prompt=PromptTemplate.from_template(_RESOLVE_TEMPLATE), verbose=_DEBUG_MODE, output_key='summary')
+    summary_chain = LLMChain(llm=llm_cheap, prompt=PromptTemplate.from_template(_SUMMARY_TEMPLATE), verbose=_DEBUG_MODE, output_key='summary')
+    return resolve_chain, summary_chain
+
+
+# run the whole chain for a question and return the summarized answer,
+# reporting each stage in status and streaming the summary into placeholder while it is generated
+def _answer(model, question, placeholder, status):
+    # set of answers
+    initial_answers = []
+    checked_answer = []
+
+    resolve_chain, summary_chain = _build_chains(model)
+
+    # we ask GPT to answer the question and double_check the answer for _REPETITIONS times in one request
+    # we then collect the answers and the double-checked results for comparison
+    status.info(f"Gathering {_REPETITIONS} answers...")
+    prompt = _QUESTION_TEMPLATE.format(question=question, initial_q_prompt=_INITIAL_Q_PROMPT,
+                                      double_checker_prompt=_DOUBLE_CHECKER_PROMPT)
+    outputs = _call_openai(_sample_answers, model, prompt)
+    if not outputs:
+        status.error("Every answer ran past the length limit. Try asking a narrower question.")
+        st.stop()
+    for output in outputs:
+        answer, checked = _parse_answer(output)
+        initial_answers.append(answer)
+        initial_answers.append(checked)
+        checked_answer.append(checked)
+
+    # an answer and its check are often near-identical, and so are the samples; sending them all only inflates the prompt
+    initial_answers = _truncate(_dedupe(initial_answers), model)
+
+    # concatenate initial_answers, with each answer enclosed in '''
+    answers = f"'''{_ANSWER_DELIMITER.join(initial_answers)}'''"
+
+
+    # if the checked answers already agree, or deduplication left a single candidate, there is nothing to compare,
+    # so we summarize the first checked answer directly
+    # otherwise we ask GPT to compare the answers and return only the concise final answer
+    # either way the answer is shown to the user token by token
+    if len(initial_answers) == 1 or _answers_agree(checked_answer):
+        status.info(f"Got {len(checked_answer)} candidate answers ✓ They agree, summarizing...")
+        summary = _call_openai(summary_chain, {'summary_prompt': _SUMMARY_PROMPT, 'final_answer': checked_answer[0]},
+                               callbacks=[_stream_handler(placeholder)])
+    else:
+        status.info(f"Got {len(checked_answer)} candidate answers ✓ Comparing {len(initial_answers)} distinct answers...")
+        formatted_resolve_prompt = _RESOLVE_PROMPT.format(repetition=len(initial_answers), question=question)
+        summary = _call_openai(resolve_chain, {'resolve_prompt': formatted_resolve_prompt, 'answers': answers},
+                               callbacks=[_stream_handler(placeholder)])
+
+    # debug output
+    if _DEBUG_MODE:
+        st.write("================================== INITIAL ANSWERS ==================================")
+        st.write(answers)
+
+        checked_answers = _ANSWER_DELIMITER.join(checked_answer)
+        st.write("================================== CHECKED ANSWERS ==================================")
+        st.write(checked_answers)
+
+        st.write("================================== ASWER ==================================")
+
+    return summary['summary']
 
 
 def initialize():
@@ -42,115 +348,37 @@ def initialize():
     submit_button = st.button('Submit')
     
 
-    # set of answers
-    initial_answers = []
-    checked_answer = []
-
-    # Prompt Templates
-    # initial question
-    initial_q_template = PromptTemplate(
-        input_variables=['question', 'initial_q_prompt'],
-        template="{initial_q_prompt} Question: {question}"
-    )
-
-    # double checker of answer to initial question
-    double_checker_template = PromptTemplate(
-        input_variables=['double_checker_prompt','question', 'answer'],
-        template="{double_checker_prompt} Question: {question} Answer: {answer}"
-    )
-
-    # comparison of collected answers
-    comparison_template = PromptTemplate(
-        input_variables=['answers', 'comparison_prompt'],
-        template="{comparison_prompt} {answers}"
-    )
-
-    # synthesis of answer comparison
-    final_answer_template = PromptTemplate(
-        input_variables=['comparison', 'final_answer_prompt'],
-        template="{final_answer_prompt} <<<{comparison}>>>"
-    )
-
-    # summary of final answer to be more concise
-    summary_template = PromptTemplate(
-        input_variables=['summary_prompt', 'final_answer'],
-        template="{summary_prompt} {final_answer}"
-    )
-
-    # api key retrieval
-    openai.api_key = apikey
-    # llms initialization
-    llms = ChatOpenAI(temperature=0.9, client=None, model=model, max_tokens= 500 )
-
-    # chain initialization
-    initial_q_chain = LLMChain(llm=llms, prompt=initial_q_template, verbose=True, output_key='answer', )
-    double_checker_chain = LLMChain(llm=llms, prompt=double_checker_template, verbose=True, output_key='checked_answer', )
-    comparison_chain = LLMChain(llm=llms, prompt=comparison_template, verbose=True, output_key='comparison')
-    final_answer_chain = LLMChain(llm=llms, prompt=final_answer_template, verbose=True, output_key='final_answer')
-    summary_chain = LLMChain(llm=llms, prompt=summary_template, verbose=True, output_key='summary')
-
-    # chain for initial question and double-checking of answer
-    question_chain = SequentialChain(chains=[initial_q_chain, double_checker_chain],
-                                        input_variables=['question', 'initial_q_prompt', 'double_checker_prompt'],
-                                        output_variables=['answer', 'checked_answer'],
-                                        verbose=True
-                                        )
-    # chain for comparison of answers and synthesis of final answer, as well as summarization
-    sequential_chain = SequentialChain(chains=[comparison_chain, final_answer_chain, summary_chain], 
-                                       input_variables=['answers','comparison_prompt', 'final_answer_prompt', 'summary_prompt'], 
-                                       output_variables=['comparison', 'final_answer', 'summary'],
-                                       verbose=True
-                                       )
-
-
     # if submit button is pressed and question is not empty, initiate chains
     if submit_button and question != '':
 
         # Example Questions: How long will it take to reach the sun if I'm travelling at the speed of 1 million kms per hour?
         #                    I left 5 clothes to dry out in the sun. It took them 5 hours to dry completely. How long would it take to dry 30 clothes?
 
+        # progress of the current stage is shown here, and the summary streams into placeholder while it is generated
+        status = st.empty()
+        placeholder = st.empty()
+
         # loading icon
         with st.spinner('Thinking...'):
-
-            # we ask GPT to answer the question and double_check the answer for _REPETITIONS times
-            # we then collect the answers and the double-checked results for comparison
-            for x in range(_REPETITIONS):
-                output = question_chain({'question':question, \
-                                        'initial_q_prompt':_INITIAL_Q_PROMPT, 'double_checker_prompt': _DOUBLE_CHECKER_PROMPT})
-                initial_answers.append(output['answer'])
-                initial_answers.append(output['checked_answer'])
-                checked_answer.append(output['checked_answer'])
-                
-
-            # concatenate initial_answers, with each answer enclosed in '''
-            answers = "'''\n'''".join(initial_answers)
-            # enclose answers with ''' delimeter
-            answers = "'''"+answers+"'''"
-
-
-            # we ask GPT to compare the answers and synthesize the final answer
-            formatted_comparison_prompt = _COMPARISON_PROMPT.format(repetition=_REPETITIONS, question=question)
-            final_answer = sequential_chain({'answers':answers, 'comparison_prompt':formatted_comparison_prompt, \
-                                             'final_answer_prompt': _FINAL_ANSWER_PROMPT, 'summary_prompt': _SUMMARY_PROMPT})
-
-            
-        # debug output
-        if _DEBUG_MODE:
-            st.write("================================== INITIAL ANSWERS ==================================")
-            st.write(answers)
-
-            checked_answers = "'''\n'''".join(checked_answer)
-            st.write("================================== CHECKED ANSWERS ==================================")
-            st.write(checked_answers)
-
-            st.write("================================== ASWER ==================================")
+            summary = _cached_answer(model, question)
+            if summary is None:
+                # a rephrasing of an earlier question is answered from the semantic cache
+                embedding = _embed(question)
+                summary = _semantic_lookup(model, embedding) if embedding is not None else None
+                if summary is None:
+                    summary = _answer(model, question, placeholder, status)
+                    if embedding is not None:
+                        _semantic_store(model, question, embedding, summary)
+                _cache_answer(model, question, summary)
 
         # output final summarized answer
-        st.write(final_answer['summary'])
+        status.empty()
+        placeholder.write(summary)
 
 
 
 def main():
+    openai.requestssession = _http_session()
     initialize()
     
 